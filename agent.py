@@ -4,14 +4,32 @@ Claude Vision identifies WHAT to click and WHERE (pixel coords).
 Bypasses all iframe/DOM issues by clicking at screen coordinates.
 """
 
+from __future__ import annotations
+
 import asyncio
-import base64
 import os
-import json
 import sys
 import time as _time
-from playwright.async_api import async_playwright, Page, BrowserContext
-import anthropic
+from io import BytesIO
+from typing import TYPE_CHECKING
+
+# playwright, anthropic (httpx, pydantic), numpy, Pillow and numba are slow to
+# import, so they are loaded inside run_agent once the browser profile is known
+# to exist
+if TYPE_CHECKING:
+    from playwright.async_api import Page, BrowserContext
+
+np = None     # numpy, set by _load_imaging()
+Image = None  # PIL.Image, set by _load_imaging()
+
+try:
+    import pybase64  # SIMD base64 that can emit str directly, without a bytes copy
+    _b64encode = pybase64.b64encode_as_string
+except ImportError:
+    import base64
+
+    def _b64encode(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
 
 # ── Config ────────────────────────────────────────────────────────────────────
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY", "your-key-here")
@@ -21,44 +39,76 @@ PROFILE_DIR       = "./browser-profile"
 CHECK_INTERVAL_SEC  = 1
 VIDEO_SKIP_SPEED    = 16
 MAX_VIDEO_WAIT_SEC  = 600
-SCREENSHOT_QUALITY  = 90   # Higher quality so Claude can read text clearly
+SCREENSHOT_QUALITY  = 75
 POPUP_WAIT_SEC      = 20
+SCREEN_HASH_SIZE    = 64   # dHash grid (64x64 = 4096 bits) for spotting unchanged screens
+SCREEN_CACHE_DIST   = 2    # Max differing dHash bits to treat two screens as identical
+CLICK_JITTER_PX     = 16   # Video-loop clicks this close to an earlier one count as repeats
 VIEWPORT_W          = 1280
 VIEWPORT_H          = 800
+VISION_W            = 1280  # Screenshots are downscaled to this before going to Claude;
+VISION_H            = 720   # coordinates Claude returns are scaled back to the viewport
 # ─────────────────────────────────────────────────────────────────────────────
 
-client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+client = None  # Set by _init_client() when the agent starts
+
+
+def _init_client():
+    """
+    Create the async client over a warm HTTP/2 connection pool so Claude calls
+    don't block the event loop or pay a fresh TLS handshake each time.
+    """
+    global client
+    import anthropic
+    import httpx
+    client = anthropic.AsyncAnthropic(
+        api_key=ANTHROPIC_API_KEY,
+        http_client=httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=8, keepalive_expiry=120.0),
+            timeout=60.0,
+        ),
+    )
 
 # ── Token Tracking ────────────────────────────────────────────────────────────
 _api_call_count = 0
 _total_input_tokens = 0
+_total_cache_write_tokens = 0
+_total_cache_read_tokens = 0
 _total_output_tokens = 0
 _total_cost = 0.0
 
 def _log_api_call(context: str, usage):
     """Track API calls and token usage."""
     global _api_call_count, _total_input_tokens, _total_output_tokens, _total_cost
+    global _total_cache_write_tokens, _total_cache_read_tokens
     _api_call_count += 1
     input_tok = usage.input_tokens
     output_tok = usage.output_tokens
-    cost = (input_tok * 3 / 1_000_000) + (output_tok * 15 / 1_000_000)
+    # Prompt-cache tokens are reported separately from input_tokens
+    cache_write_tok = getattr(usage, "cache_creation_input_tokens", 0) or 0
+    cache_read_tok = getattr(usage, "cache_read_input_tokens", 0) or 0
+    cost = (
+        (input_tok * 3 / 1_000_000)
+        + (cache_write_tok * 3.75 / 1_000_000)
+        + (cache_read_tok * 0.30 / 1_000_000)
+        + (output_tok * 15 / 1_000_000)
+    )
     _total_input_tokens += input_tok
+    _total_cache_write_tokens += cache_write_tok
+    _total_cache_read_tokens += cache_read_tok
     _total_output_tokens += output_tok
     _total_cost += cost
-    print(f"[API #{_api_call_count}] {context} | in={input_tok} out={output_tok} cost=${cost:.4f} | TOTAL: ${_total_cost:.4f}")
+    print(f"[API #{_api_call_count}] {context} | in={input_tok} cache_w={cache_write_tok} cache_r={cache_read_tok} "
+          f"out={output_tok} cost=${cost:.4f} | TOTAL: ${_total_cost:.4f}")
 
 
 # ── Claude Vision ─────────────────────────────────────────────────────────────
 
-def analyze_screen(screenshot_bytes: bytes, hint: str = "", context: str = "analyze") -> dict:
-    """
-    Ask Claude to analyze the screen and return coordinates to click.
-    Returns pixel (x, y) for every action needed.
-    """
-    system_prompt = f"""You are an AI agent controlling a browser to complete online training courses.
-The browser viewport is {VIEWPORT_W}x{VIEWPORT_H} pixels.
-
-Analyze the screenshot and return ONLY valid JSON with NO markdown fences.
+# Built once at import so the bytes are identical on every call — the prompt
+# cache only hits on an exact prefix match.
+SYSTEM_PROMPT = f"""You are an AI agent controlling a browser to complete online training courses.
+The screenshot is {VISION_W}x{VISION_H} pixels.
 
 Determine the current state:
 - "video"       -> A video or animated slide is playing/showing
@@ -74,16 +124,9 @@ IMPORTANT RULES:
 - Only use "quiz" if answers have NOT been selected yet
 - Navigation arrows (> or >> or arrow icons at edges) count as next_button clicks
 
-For each clickable item, provide the CENTER pixel coordinates (x, y) within the viewport.
+For each clickable item, provide the CENTER pixel coordinates (x, y) within the screenshot.
 
-Return this exact JSON structure:
-{{
-  "state": "<state>",
-  "reasoning": "<one sentence explaining what you see>",
-  "clicks": [
-    {{"label": "<what this click does>", "x": <pixel x>, "y": <pixel y>}}
-  ]
-}}
+Always answer by calling the report_screen tool.
 
 The "clicks" array should contain:
 - For quiz (unanswered): one entry per answer to select PLUS the Submit button
@@ -91,9 +134,128 @@ The "clicks" array should contain:
 - For video with interactive element: one entry for that element
 - For other states: empty array []
 
+Set "popup_open" when a modal/popup with an X close button is visible, with "popup_x"
+at the center of that X button.
+
+If your clicks close a popup or submit an answer, and the Next/arrow button that advances
+the slide afterwards is visible, set "post_click_next" to that button; otherwise null.
+
 Be precise — click the CENTER of buttons, checkboxes, and arrows.
 """
-    img_b64 = base64.standard_b64encode(screenshot_bytes).decode()
+
+_POINT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "x": {"type": "integer", "description": f"Pixel column in the {VISION_W}x{VISION_H} screenshot."},
+        "y": {"type": "integer", "description": f"Pixel row in the {VISION_W}x{VISION_H} screenshot."},
+    },
+    "required": ["x", "y"],
+}
+
+_CLICK_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "label": {"type": "string", "description": "What this click does."},
+        **_POINT_SCHEMA["properties"],
+    },
+    "required": ["label", "x", "y"],
+}
+
+# Forcing this tool makes Claude return a schema-checked dict instead of free text
+REPORT_SCREEN_TOOL = {
+    "name": "report_screen",
+    "description": "Report the state of the screen and the pixel coordinates to click.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "state": {
+                "type": "string",
+                "enum": ["video", "quiz", "next_button", "complete", "login", "unknown"],
+                "description": "Current screen state, as defined in the system prompt.",
+            },
+            "reasoning": {"type": "string", "description": "One sentence explaining what you see."},
+            "clicks": {
+                "type": "array",
+                "description": "Clicks to perform, in order, at the CENTER of each target. Empty if none.",
+                "items": _CLICK_SCHEMA,
+            },
+            "popup_open": {
+                "type": "boolean",
+                "description": "True if a modal/popup/overlay with an X close button is visible.",
+            },
+            "popup_x": {
+                "anyOf": [_POINT_SCHEMA, {"type": "null"}],
+                "description": "Center of the popup's X close button, or null.",
+            },
+            "post_click_next": {
+                "anyOf": [_CLICK_SCHEMA, {"type": "null"}],
+                "description": "Next/arrow button to click after the clicks close a popup or submit an answer, "
+                               "if it is already visible; otherwise null.",
+            },
+            "menu_items": {
+                "type": "array",
+                "description": "Course menu modules, top to bottom, when asked to list them.",
+                "items": {
+                    "type": "object",
+                    "properties": {**_CLICK_SCHEMA["properties"], "done": {"type": "boolean"}},
+                    "required": ["label", "x", "y", "done"],
+                },
+            },
+            "unchecked": {
+                "type": "array",
+                "description": "Indices of the listed menu modules that are not checked off yet.",
+                "items": {"type": "integer"},
+            },
+        },
+        "required": ["state", "clicks"],
+    },
+}
+
+
+# Output budget per call context — sized to what each report_screen reply needs
+MAX_TOKENS_BY_CONTEXT = {
+    "menu_check":       256,
+    "stuck_check":      256,
+    "video_loop":       1024,  # "ALL interactive items" — 20+ clicks at ~25 tokens each
+    "main_loop":        768,
+    "next_module_scan": 1024,
+}
+
+
+async def analyze_screen(screenshot_bytes: bytes, hint: str = "", context: str = "analyze",
+                         max_tokens: int | None = None) -> dict:
+    """
+    Ask Claude to analyze the screen and return coordinates to click.
+    Returns viewport pixel (x, y) for every action needed.
+    max_tokens defaults to the budget for this context in MAX_TOKENS_BY_CONTEXT;
+    a reply cut off by it is retried once with double the budget.
+    """
+    if max_tokens is None:
+        max_tokens = MAX_TOKENS_BY_CONTEXT.get(context, 1024)
+    analysis, stop_reason = await _ask_claude(screenshot_bytes, hint, context, max_tokens)
+    if stop_reason == "max_tokens":
+        print(f"[WARN] {context} reply hit max_tokens={max_tokens} — retrying with {max_tokens * 2}")
+        analysis, stop_reason = await _ask_claude(screenshot_bytes, hint, context, max_tokens * 2)
+        if stop_reason == "max_tokens":
+            # A truncated tool call can be missing clicks or fields — don't act on it
+            print(f"[WARN] {context} reply truncated again — treating screen as unknown")
+            analysis = {"state": "unknown", "reasoning": "", "clicks": []}
+    for key in ("clicks", "menu_items"):
+        if key in analysis:
+            analysis[key] = [_to_viewport(c) for c in analysis[key] or []]
+    analysis.setdefault("clicks", [])
+    for key in ("popup_x", "post_click_next"):
+        if analysis.get(key):
+            analysis[key] = _to_viewport(analysis[key])
+    return analysis
+
+
+async def _ask_claude(screenshot_bytes: bytes, hint: str, context: str, max_tokens: int) -> tuple[dict, str]:
+    """
+    Send one screenshot to Claude and return its report_screen input (screenshot
+    coordinates) along with the response's stop_reason.
+    """
+    img_b64 = _b64encode(screenshot_bytes)
     user_content = []
     if hint:
         user_content.append({"type": "text", "text": f"Context: {hint}"})
@@ -101,67 +263,161 @@ Be precise — click the CENTER of buttons, checkboxes, and arrows.
         "type": "image",
         "source": {"type": "base64", "media_type": "image/jpeg", "data": img_b64}
     })
-    user_content.append({"type": "text", "text": "Analyze this screen and return JSON with pixel coordinates."})
+    user_content.append({"type": "text", "text": "Analyze this screen and report pixel coordinates with report_screen."})
 
-    response = client.messages.create(
+    response = await client.messages.create(
         model="claude-sonnet-4-6",
-        max_tokens=2048,
-        system=system_prompt,
-        messages=[{"role": "user", "content": user_content}]
+        max_tokens=max_tokens,
+        # The cache breakpoint covers tools + system. Sonnet only caches prefixes of
+        # 1,024+ tokens, which is why the tool schema carries its field descriptions
+        system=[{"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+        tools=[REPORT_SCREEN_TOOL],
+        tool_choice={"type": "tool", "name": "report_screen"},
+        messages=[{"role": "user", "content": user_content}],
     )
     
     # Track token usage
     _log_api_call(context, response.usage)
 
-    raw = response.content[0].text.strip()
-    # Strip markdown fences if present
-    if "```" in raw:
-        parts = raw.split("```")
-        for part in parts:
-            part = part.strip()
-            if part.startswith("json"):
-                part = part[4:].strip()
-            try:
-                return json.loads(part)
-            except Exception:
-                continue
+    for block in response.content:
+        if block.type == "tool_use":
+            return dict(block.input), response.stop_reason
+    print(f"[WARN] No report_screen call in Claude response (stop_reason={response.stop_reason})")
+    return {"state": "unknown", "reasoning": "", "clicks": []}, response.stop_reason
+
+
+# ── Screenshot Cache ──────────────────────────────────────────────────────────
+# (context, dHash, analysis) of the previous call. If the next screenshot for the
+# same context is unchanged, that answer is reused instead of calling Claude.
+# Only passive states are kept — a cached quiz/next_button answer would repeat
+# clicks that have already changed the page (e.g. un-ticking answers).
+_CACHEABLE_STATES = ("video", "unknown")
+_last_screen = None
+
+
+def invalidate_screen_cache():
+    """Forget the previous screen; call after anything that changes the page."""
+    global _last_screen
+    _last_screen = None
+
+
+class Screenshot(bytes):
+    """JPEG bytes sent to Claude, carrying the dHash computed from the same image."""
+    dhash = None
+
+
+def _dhash(img):
+    """4096-bit difference hash of a PIL image's grayscale thumbnail, as 64 uint64 words."""
+    img = img.convert("L").resize((SCREEN_HASH_SIZE + 1, SCREEN_HASH_SIZE), Image.BILINEAR)
+    return _dhash_words(np.asarray(img, dtype=np.uint8))
+
+
+def _dhash_words(luma):
+    """One bit per horizontally adjacent pixel pair: set if the left one is brighter."""
+    rows, cols = luma.shape[0], luma.shape[1] - 1
+    words = np.zeros((rows * cols + 63) // 64, dtype=np.uint64)
+    for row in range(rows):
+        for col in range(cols):
+            if luma[row, col] > luma[row, col + 1]:
+                bit = row * cols + col
+                words[bit // 64] |= np.uint64(1) << np.uint64(bit % 64)
+    return words
+
+
+def _hamming(a, b):
+    n = 0
+    for i in range(a.shape[0]):
+        x = a[i] ^ b[i]
+        while x:
+            x = x & (x - np.uint64(1))
+            n += 1
+    return n
+
+
+def _load_imaging():
+    """Import numpy and Pillow, and JIT the hash loops with numba if it is installed."""
+    global np, Image, _dhash_words, _hamming
+    import numpy
+    from PIL import Image as PILImage
+    np, Image = numpy, PILImage
     try:
-        return json.loads(raw)
-    except json.JSONDecodeError:
-        # Try to salvage partial/truncated JSON by extracting what we can
-        salvaged = _salvage_json(raw)
-        if salvaged:
-            return salvaged
-        print(f"[WARN] Could not parse Claude response: {raw[:300]}")
-        return {"state": "unknown", "reasoning": raw, "clicks": []}
-
-
-def _salvage_json(raw: str) -> dict:
-    """Extract state and valid clicks from malformed/truncated JSON."""
-    import re
-    result = {"state": "unknown", "reasoning": "", "clicks": []}
-    # Extract state
-    m = re.search(r'"state"\s*:\s*"(\w+)"', raw)
-    if m:
-        result["state"] = m.group(1)
-    # Extract reasoning
-    m2 = re.search(r'"reasoning"\s*:\s*"([^"]*)"', raw)
-    if m2:
-        result["reasoning"] = m2.group(1)
-    # Extract all well-formed click objects: {"label": "...", "x": N, "y": N}
-    clicks = re.findall(r'\{[^}]*"label"\s*:\s*"([^"]+)"[^}]*"x"\s*:\s*(\d+)[^}]*"y"\s*:\s*(\d+)[^}]*\}', raw)
-    for label, x, y in clicks:
-        result["clicks"].append({"label": label, "x": int(x), "y": int(y)})
-    if result["state"] != "unknown" or result["clicks"]:
-        print(f"[SALVAGE] Recovered state={result['state']} with {len(result['clicks'])} clicks")
-        return result
-    return None
+        from numba import njit
+    except ImportError:  # numba is optional; the hash loops then run as plain Python
+        return
+    _dhash_words = njit(cache=True)(_dhash_words)
+    _hamming = njit(cache=True)(_hamming)
+
+
+async def analyze_screen_cached(screenshot_bytes: bytes, hint: str = "", context: str = "analyze") -> dict:
+    """analyze_screen, but reuses the previous analysis if the screen hasn't changed."""
+    global _last_screen
+    h = getattr(screenshot_bytes, "dhash", None)
+    if h is None:
+        h = await asyncio.to_thread(lambda: _dhash(Image.open(BytesIO(screenshot_bytes))))
+    if _last_screen is not None:
+        prev_context, prev_hash, prev_analysis = _last_screen
+        if prev_context == context and _hamming(prev_hash, h) <= SCREEN_CACHE_DIST:
+            print(f"[CACHE] {context} | screen unchanged — reusing last analysis")
+            return prev_analysis
+    analysis = await analyze_screen(screenshot_bytes, hint, context)
+    if analysis.get("state") in _CACHEABLE_STATES:
+        _last_screen = (context, h, analysis)
+    else:
+        _last_screen = None
+    return analysis
 
 
 # ── Page Actions ───────────────────────────────────────────────────────────────
 
-async def take_screenshot(page: Page) -> bytes:
-    return await page.screenshot(type="jpeg", quality=SCREENSHOT_QUALITY)
+def _downscale_jpeg(png: bytes) -> Screenshot:
+    """
+    Resize a lossless capture to VISION_W x VISION_H, JPEG-encode it once and
+    hash the resized image for the screen cache.
+    """
+    img = Image.open(BytesIO(png)).convert("RGB").resize((VISION_W, VISION_H), Image.BILINEAR)
+    buf = BytesIO()
+    img.save(buf, "JPEG", quality=SCREENSHOT_QUALITY, optimize=True)
+    shot = Screenshot(buf.getvalue())
+    shot.dhash = _dhash(img)
+    return shot
+
+
+async def take_screenshot(page: Page) -> Screenshot:
+    """
+    Capture the viewport and downscale it to VISION_W x VISION_H for Claude.
+    The capture is PNG so small text only goes through one lossy encode, and the
+    Pillow work (resize, encode, dHash) runs in a thread to keep the event loop free.
+    """
+    raw = await page.screenshot(type="png")
+    return await asyncio.to_thread(_downscale_jpeg, raw)
+
+
+def _to_viewport(point: dict) -> dict:
+    """Scale an {x, y} point from screenshot coordinates back to viewport pixels."""
+    if not isinstance(point, dict) or point.get("x") is None or point.get("y") is None:
+        return point
+    return {**point,
+            "x": point["x"] * VIEWPORT_W // VISION_W,
+            "y": point["y"] * VIEWPORT_H // VISION_H}
+
+
+# Centre of the first visible "next"-looking control in the page, or null
+_FIND_NEXT_ARROW_JS = """() => {
+    const sel = 'button[aria-label*="next" i], button[title*="next" i], .next-arrow, [class*="next"]';
+    const el = [...document.querySelectorAll(sel)].find(e => e.offsetParent);
+    if (!el) return null;
+    const r = el.getBoundingClientRect();
+    return [Math.round(r.x + r.width / 2), Math.round(r.y + r.height / 2)];
+}"""
+
+
+async def find_next_arrow(page: Page):
+    """Locate a next/advance control via the DOM; returns (x, y) or None."""
+    try:
+        return await page.evaluate(_FIND_NEXT_ARROW_JS)
+    except Exception as e:
+        print(f"[AGENT] Next-arrow DOM query failed: {e}")
+        return None
 
 
 async def get_active_page(context: BrowserContext, current: Page) -> Page:
@@ -173,8 +429,25 @@ async def get_active_page(context: BrowserContext, current: Page) -> Page:
     return current
 
 
+_cdp_sessions: dict = {}  # Page -> CDPSession, opened on first use
+
+
+async def _cdp_session(page: Page):
+    cdp = _cdp_sessions.get(page)
+    if cdp is None:
+        cdp = await page.context.new_cdp_session(page)
+        _cdp_sessions[page] = cdp
+    return cdp
+
+
 async def perform_clicks(page: Page, clicks: list):
-    """Click each coordinate in sequence."""
+    """
+    Click each coordinate in sequence. Clicks go straight to CDP as raw mouse
+    events with a short gap, and the UI only gets time to settle after the batch.
+    """
+    invalidate_screen_cache()
+    cdp = await _cdp_session(page)
+    clicked = False
     for item in clicks:
         x = item.get("x")
         y = item.get("y")
@@ -182,72 +455,92 @@ async def perform_clicks(page: Page, clicks: list):
         if x is None or y is None:
             print(f"[CLICK] Skipping '{label}' — no coordinates")
             continue
+        if clicked:
+            await asyncio.sleep(0.05)
         print(f"[CLICK] {label} at ({x}, {y})")
-        await page.mouse.click(x, y)
+        for event in ("mousePressed", "mouseReleased"):
+            await cdp.send("Input.dispatchMouseEvent", {
+                "type": event, "x": x, "y": y, "button": "left", "clickCount": 1,
+            })
+        clicked = True
+    if clicked:
         await asyncio.sleep(0.4)
 
 
-async def speed_up_video(page: Page):
-    try:
-        await page.evaluate(f"""
-            document.querySelectorAll('video').forEach(v => {{
-                v.playbackRate = {VIDEO_SKIP_SPEED};
-                v.muted = true;
-                if (v.duration > 0) v.currentTime = v.duration - 2;
-            }});
-            document.querySelectorAll('iframe').forEach(f => {{
-                try {{
-                    f.contentDocument.querySelectorAll('video').forEach(v => {{
-                        v.playbackRate = {VIDEO_SKIP_SPEED};
-                        v.muted = true;
-                        if (v.duration > 0) v.currentTime = v.duration - 2;
-                    }});
-                }} catch(e) {{}}
-            }});
-        """)
-    except Exception as e:
-        print(f"[VIDEO] Speed up error: {e}")
+# Installed once per context: every frame fast-forwards its videos as soon as they
+# appear or load metadata, so the video loop needs no periodic page.evaluate.
+# Each source is only seeked once, since players re-render the DOM constantly;
+# the rate is re-forced whenever a player resets it on play or source change.
+_VIDEO_SPEED_SCRIPT = f"""(() => {{
+    const fix = v => {{
+        if (v.playbackRate !== {VIDEO_SKIP_SPEED}) v.playbackRate = {VIDEO_SKIP_SPEED};
+        v.muted = true;
+        if (v.duration > 0 && v._lmsSkipped !== v.currentSrc) {{
+            v._lmsSkipped = v.currentSrc;
+            v.currentTime = v.duration - 2;
+        }}
+    }};
+    const fixAll = () => document.querySelectorAll('video').forEach(fix);
+    new MutationObserver(fixAll).observe(document, {{childList: true, subtree: true}});
+    for (const type of ['loadedmetadata', 'play', 'ratechange']) {{
+        document.addEventListener(type, e => {{
+            if (e.target instanceof HTMLVideoElement) fix(e.target);
+        }}, true);
+    }}
+    fixAll();
+}})()"""
 
 
 async def wait_for_video_to_end(page: Page, clicked_items: set = None) -> bool:
-    """One API call per 6s cycle. Single prompt handles next detection + interactions."""
+    """
+    One API call per 6s cycle. Single prompt handles next detection + interactions.
+    clicked_items holds the labels already clicked and persists across calls; the
+    positions clicked are only remembered for this call, since later slides reuse
+    the same layout. A candidate within CLICK_JITTER_PX of one of them counts as
+    already clicked, even if Claude labelled it differently.
+    """
     if clicked_items is None:
         clicked_items = set()
+    clicked_xs, clicked_ys = [], []
     print("[VIDEO] Monitoring video (checking every 6s)...")
-    elapsed = 0
+    loop = asyncio.get_running_loop()
+    started = loop.time()  # Wall clock, so settle sleeps after clicks count too
     stuck_count = 0
-
-    while elapsed < MAX_VIDEO_WAIT_SEC:
-        await speed_up_video(page)
-        await asyncio.sleep(6)
-        elapsed += 6
-
-        screenshot = await take_screenshot(page)
-
-        # Single call handles everything
-        analysis = analyze_screen(screenshot,
-            "Analyze this training slide. Return JSON with: "
+    delay = 6
+    screenshot = await take_screenshot(page)
+
+    while loop.time() - started < MAX_VIDEO_WAIT_SEC:
+        # Single call handles everything — it runs while we wait out the cycle,
+        # and the next screenshot is captured before its answer is awaited
+        analysis_task = asyncio.create_task(analyze_screen_cached(screenshot,
+            "Analyze this training slide. Report: "
             "state ('next_button' if 'click the next arrow' text is visible AND no popup is open, else 'video'), "
             "popup_open (bool: is a modal/popup with X button visible?), "
             "popup_x (object with x,y of the X close button, or null), "
             "clicks (array of ALL interactive content items with label/x/y - include ALL blocks/tabs/buttons even if highlighted/visited, "
             "EXCLUDE only: MENU, TRANSCRIPT, play/pause, volume, settings, < > player nav arrows).",
-            context="video_loop")
+            context="video_loop"))
+        await asyncio.sleep(delay)
+        delay = 6
+        next_shot = asyncio.create_task(take_screenshot(page))
+        analysis = await analysis_task
 
         state      = analysis.get("state", "video")
         popup_open = analysis.get("popup_open", False)
         popup_x    = analysis.get("popup_x") or {}
         clicks     = analysis.get("clicks", [])
 
-        print(f"[VIDEO] {elapsed}s state={state} popup={popup_open} items={len(clicks)}")
+        print(f"[VIDEO] {loop.time() - started:.0f}s state={state} popup={popup_open} items={len(clicks)}")
 
         # Exit if next arrow is ready
         if state == "next_button" and not popup_open:
             print("[VIDEO] Next arrow ready — handing off.")
+            await next_shot
             return True
 
         # Close popup if open
         if popup_open:
+            invalidate_screen_cache()
             px, py = popup_x.get("x"), popup_x.get("y")
             if px and py:
                 print(f"[VIDEO] Closing popup at ({px},{py})")
@@ -262,53 +555,63 @@ async def wait_for_video_to_end(page: Page, clicked_items: set = None) -> bool:
                 for cx, cy in [(608, 191), (609, 195), (600, 190), (610, 185)]:
                     await page.mouse.click(cx, cy)
                     await asyncio.sleep(0.2)
+            # The prefetched screenshot predates the close — take a fresh one
+            await next_shot
             await asyncio.sleep(0.8)
+            screenshot = await take_screenshot(page)
             continue
 
-        # Filter already-clicked items
-        new_clicks = [c for c in clicks if c.get("label","") not in clicked_items]
-
-        if not new_clicks:
+        # Column-wise view of the candidates, so the already-clicked filter (by label,
+        # or by distance in case Claude words the same element differently from one
+        # cycle to the next) and the player-chrome check are single vectorized passes
+        n = len(clicks)
+        labels = np.array([c.get("label", "") for c in clicks], dtype=str)
+        xs = np.fromiter((c.get("x") or 0 for c in clicks), dtype=np.int64, count=n)
+        ys = np.fromiter((c.get("y") or 0 for c in clicks), dtype=np.int64, count=n)
+        seen_labels = np.array(list(clicked_items), dtype=str)
+        near_clicked = ((np.abs(xs[:, None] - np.array(clicked_xs, dtype=np.int64)) <= CLICK_JITTER_PX)
+                        & (np.abs(ys[:, None] - np.array(clicked_ys, dtype=np.int64)) <= CLICK_JITTER_PX)).any(axis=1)
+        unseen = ~np.isin(labels, seen_labels) & ~near_clicked
+
+        if not unseen.any():
             stuck_count += 1
             if stuck_count >= 2:
                 print("[VIDEO] All interactions done — trying next arrow before exiting.")
+                invalidate_screen_cache()
+                await next_shot
                 # Try common next arrow positions
                 for ax, ay in [(625, 537), (620, 535), (630, 540), (601, 339)]:
                     await page.mouse.click(ax, ay)
                     await asyncio.sleep(0.3)
                 return True
+            screenshot = await next_shot
             continue
 
         stuck_count = 0
-        for item in new_clicks:
-            x, y = item.get("x"), item.get("y")
+        has_coords = (xs > 0) & (ys > 0)
+        in_chrome = (ys < 90) | (ys > 630)
+        for i in np.flatnonzero(unseen & has_coords & in_chrome):
+            print(f"[VIDEO] BLOCKED chrome: {clicks[i].get('label', '?')} at ({xs[i]},{ys[i]})")
+
+        targets = np.flatnonzero(unseen & has_coords & ~in_chrome)
+        if targets.size:
+            item = clicks[targets[0]]
+            x, y = int(xs[targets[0]]), int(ys[targets[0]])
             label = item.get("label", "?")
-            if not x or not y:
-                continue
-            if y < 90 or y > 630:
-                print(f"[VIDEO] BLOCKED chrome: {label} at ({x},{y})")
-                continue
             print(f"[VIDEO] Clicking: {label} at ({x},{y})")
+            invalidate_screen_cache()
             await page.mouse.click(x, y)
             clicked_items.add(label)
+            clicked_xs.append(x)
+            clicked_ys.append(y)
+            # Any popup this opened is handled by the next cycle's call — look again
+            # once the UI settles, without waiting out a full cycle
+            await next_shot
             await asyncio.sleep(1.2)
-            # Quick screenshot to close any popup that appeared — reuse next cycle's call
-            ss2 = await take_screenshot(page)
-            chk = analyze_screen(ss2, 
-                "Check if a modal/popup/overlay with an X close button is now visible. "
-                "Return JSON: popup_open (true if modal visible), popup_x (object with x,y of X button, or null).",
-                context="popup_check")
-            if chk.get("popup_open"):
-                p2 = chk.get("popup_x") or {}
-                px2, py2 = p2.get("x"), p2.get("y")
-                if px2 and py2:
-                    await page.mouse.click(px2, py2)
-                else:
-                    # LMS-specific fallback positions
-                    for cx, cy in [(608, 191), (609, 195), (600, 190)]:
-                        await page.mouse.click(cx, cy)
-                        await asyncio.sleep(0.2)
-                await asyncio.sleep(0.6)
+            screenshot = await take_screenshot(page)
+            delay = 0
+        else:
+            screenshot = await next_shot
 
     print("[VIDEO] Timed out.")
     return False
@@ -323,6 +626,10 @@ async def run_agent():
         print("  Run  python3 save_session.py  first.")
         sys.exit(1)
 
+    from playwright.async_api import async_playwright
+    _init_client()
+    _load_imaging()
+
     async with async_playwright() as pw:
         context = await pw.chromium.launch_persistent_context(
             user_data_dir=PROFILE_DIR,
@@ -331,8 +638,10 @@ async def run_agent():
             viewport={"width": VIEWPORT_W, "height": VIEWPORT_H},
             args=["--disable-blink-features=AutomationControlled"],
         )
+        await context.add_init_script(_VIDEO_SPEED_SCRIPT)
 
-        page = await context.new_page()
+        # Reuse the tab Chromium restores at launch instead of opening another
+        page = context.pages[0] if context.pages else await context.new_page()
         print(f"[AGENT] Navigating to {TRAINING_URL}")
         await page.goto(TRAINING_URL, wait_until="networkidle")
 
@@ -357,13 +666,14 @@ async def run_agent():
         same_action_count = 0
         max_same_action = 2
         modules_done = 0
+        menu_items = []  # Course menu layout, learned on the first module completion
         slide_clicked_items = set()  # Persists across video loop re-entries  # If same clicks repeat 2x, force next_button scan
 
         while True:
             page = await get_active_page(context, page)
 
             screenshot = await take_screenshot(page)
-            analysis   = analyze_screen(screenshot, context="main_loop")
+            analysis   = await analyze_screen_cached(screenshot, context="main_loop")
             state      = analysis.get("state", "unknown")
             reasoning  = analysis.get("reasoning", "")
             clicks     = analysis.get("clicks", [])
@@ -373,38 +683,35 @@ async def run_agent():
             if clicks:
                 print(f"[CLICKS] {[c.get('label') for c in clicks]}")
 
-            # Loop detection — if same clicks repeat, try progressively different arrow positions
+            # Loop detection — if same clicks repeat, look for the next arrow another way
             current_labels = [c.get("label","") for c in clicks]
             if current_labels and current_labels == last_click_labels:
                 same_action_count += 1
                 if same_action_count >= max_same_action:
-                    print(f"[AGENT] Stuck on same slide — trying all possible next arrows...")
-                    # Try a series of known arrow/next-button hotspots across the player
-                    # Note: popup window is ~668x569, so coordinates are relative to that
-                    arrow_candidates = [
-                        (625, 537),  # bottom-right player nav arrow
-                        (620, 535),
-                        (630, 540),
-                        (640, 537),
-                        (601, 400),  # mid-slide area
-                        (620, 450),
-                        (600, 500),
-                        (334, 440),  # center area
-                        (589, 447),  # START button area
-                    ]
-                    for ax, ay in arrow_candidates:
-                        print(f"[AGENT] Trying arrow at ({ax}, {ay})")
+                    print("[AGENT] Stuck on same slide — looking for a next arrow in the DOM...")
+                    invalidate_screen_cache()
+                    arrow = await find_next_arrow(page)
+                    advanced = False
+                    if arrow:
+                        ax, ay = arrow
+                        print(f"[AGENT] DOM next arrow at ({ax}, {ay})")
                         await page.mouse.click(ax, ay)
                         await asyncio.sleep(0.8)
-                        # Take screenshot and check if slide changed
-                        ss_check = await take_screenshot(page)
-                        check = analyze_screen(ss_check, "Did the slide advance? Is this a different slide now?", context="stuck_check")
-                        new_labels = [c.get("label","") for c in check.get("clicks", [])]
-                        if new_labels != current_labels or check.get("state") != state:
-                            print(f"[AGENT] Slide advanced after clicking ({ax}, {ay})!")
-                            clicks = check.get("clicks", [])
-                            state = check.get("state", state)
-                            break
+                        # The selector is broad — make sure the click actually moved the slide
+                        after = await take_screenshot(page)
+                        advanced = _hamming(screenshot.dhash, after.dhash) > SCREEN_CACHE_DIST
+                        if not advanced:
+                            print("[AGENT] DOM click didn't change the screen — asking Claude")
+                        screenshot = after
+                    if not advanced:
+                        # No usable DOM match (e.g. canvas/iframe player) — ask Claude once
+                        check = await analyze_screen(screenshot,
+                            "The agent is stuck on this slide: the same clicks keep repeating. "
+                            "Find the NEXT navigation arrow or button that advances to the next slide. "
+                            "Return state='next_button' and the coordinates of that arrow.",
+                            context="stuck_check")
+                        await perform_clicks(page, check.get("clicks", []))
+                        await asyncio.sleep(0.8)
                     same_action_count = 0
                     last_click_labels = []
                     continue
@@ -414,31 +721,54 @@ async def run_agent():
 
             if state == "complete":
                 modules_done += 1
+                invalidate_screen_cache()  # New module — never reuse old screens
                 print(f"[AGENT] Module {modules_done} complete! Scanning course menu for next unchecked module...")
                 await asyncio.sleep(2)
 
                 # Take a fresh screenshot and zoom into the left menu area specifically
                 ss_next = await take_screenshot(page)
 
-                next_analysis = analyze_screen(ss_next,
-                    "A module just completed. The course player is still open. "
-                    "Look at the Course Menu on the LEFT SIDE of the screen. "
-                    "It shows a list of modules with checkboxes. "
-                    "Checked modules have a checkmark (done). Unchecked modules have an empty box (not done). "
-                    "Find the FIRST unchecked/incomplete module link in that left menu and return its coordinates. "
-                    "The menu items are typically in the left 200px of the screen, spread vertically. "
-                    "Return state='next_button' and the EXACT center coordinates of that unchecked module text link. "
-                    "Do NOT click anywhere near y=0 to y=50 (that is the top bar, not the menu). "
-                    "Menu items are typically between y=100 and y=500.",
-                    context="next_module_scan")
-                next_clicks = next_analysis.get("clicks", [])
+                next_clicks = None
+                if menu_items:
+                    # Menu layout is already known — only ask which entries are unchecked
+                    listing = "; ".join(f"{i}: {m.get('label')}" for i, m in enumerate(menu_items))
+                    menu_check = await analyze_screen(ss_next,
+                        "A module just completed. The Course Menu on the LEFT SIDE lists these modules, "
+                        f"top to bottom: {listing}. "
+                        "Return state='next_button', an empty clicks array, and in 'unchecked' the indices "
+                        "of the modules that do NOT have a checkmark yet.",
+                        context="menu_check")
+                    reported = menu_check.get("unchecked")
+                    if reported is not None:
+                        unchecked = [i for i in reported if 0 <= i < len(menu_items)]
+                        if unchecked:
+                            next_clicks = [menu_items[unchecked[0]]]
+                        elif not reported:
+                            next_clicks = []  # Claude says every module is checked off
+                        # Only out-of-range indices — don't trust it, rescan the menu below
+
+                if next_clicks is None:
+                    next_analysis = await analyze_screen(ss_next,
+                        "A module just completed. The course player is still open. "
+                        "Look at the Course Menu on the LEFT SIDE of the screen. "
+                        "It shows a list of modules with checkboxes. "
+                        "Checked modules have a checkmark (done). Unchecked modules have an empty box (not done). "
+                        "Find the FIRST unchecked/incomplete module link in that left menu and return its coordinates. "
+                        "The menu items are typically in the left 200px of the screen, spread vertically. "
+                        "Return state='next_button' and the EXACT center coordinates of that unchecked module text link. "
+                        "Also list EVERY module in that menu, top to bottom, in menu_items (done=true if checked). "
+                        "Do NOT click anywhere near y=0 to y=45 (that is the top bar, not the menu). "
+                        "Menu items are typically between y=90 and y=450.",
+                        context="next_module_scan")
+                    next_clicks = next_analysis.get("clicks", [])
+                    menu_items = next_analysis.get("menu_items") or []
                 print(f"[AGENT] Next module scan: {[c.get('label') for c in next_clicks]}")
 
                 if next_clicks:
                     # Validate the click is in a reasonable menu position
                     for click in next_clicks:
                         cx, cy = click.get("x", 0), click.get("y", 0)
-                        if cy < 80:
+                        if cy < 80:  # Viewport pixels — coordinates are already scaled back
                             print(f"[AGENT] Ignoring bad coordinate ({cx},{cy}) — too close to top bar")
                             continue
                         print(f"[CLICK] {click.get('label')} at ({cx}, {cy})")
@@ -458,6 +788,7 @@ async def run_agent():
 
             elif state == "video":
                 await wait_for_video_to_end(page, slide_clicked_items)
+                invalidate_screen_cache()
                 # Don't clear clicked_items here - it causes re-clicking on same slide
                 # Items will naturally not match on new slides anyway
                 await asyncio.sleep(1)
@@ -466,26 +797,16 @@ async def run_agent():
                 if clicks:
                     await perform_clicks(page, clicks)
                     await asyncio.sleep(0.6)
-                    # After any click, check if we just closed a popup or submitted —
-                    # if so, immediately scan for the Next navigation arrow
+                    # If we just closed a popup or submitted, follow up with the Next
+                    # arrow Claude already located in the same call
                     labels_lower = [c.get("label","").lower() for c in clicks]
                     just_closed = any(w in l for l in labels_lower for w in ["close", "correct", "popup", "dismiss", "submit"])
-                    if just_closed:
+                    post_next = analysis.get("post_click_next")
+                    if just_closed and post_next:
+                        await asyncio.sleep(0.6)
+                        print(f"[NAV] Post-action next: {post_next.get('label')}")
+                        await perform_clicks(page, [post_next])
                         await asyncio.sleep(0.6)
-                        ss_nav = await take_screenshot(page)
-                        nav_analysis = analyze_screen(ss_nav,
-                            "A quiz was just answered correctly and the popup was closed. "
-                            "The quiz slide is still visible with answers checked. "
-                            "Find the NEXT navigation arrow or button to advance to the next slide. "
-                            "It is usually a right-facing arrow (>) at the right edge or bottom of the player. "
-                            "Return state='next_button' and the coordinates of that arrow.",
-                            context="post_quiz_nav")
-                        nav_clicks = nav_analysis.get("clicks", [])
-                        nav_state  = nav_analysis.get("state", "")
-                        print(f"[NAV] Post-action scan: {nav_state} — {[c.get('label') for c in nav_clicks]}")
-                        if nav_clicks and nav_state == "next_button":
-                            await perform_clicks(page, nav_clicks)
-                            await asyncio.sleep(0.6)
                 else:
                     print("[AGENT] No clicks identified, waiting...")
                     await asyncio.sleep(CHECK_INTERVAL_SEC)
@@ -507,6 +828,7 @@ async def run_agent():
             await asyncio.sleep(CHECK_INTERVAL_SEC)
 
         await context.close()
+        await client.close()
         
         # Print final stats
         elapsed_min = (_time.time() - start_time) / 60
@@ -515,6 +837,8 @@ async def run_agent():
         print(f"  Elapsed time:   {elapsed_min:.1f} minutes")
         print(f"  API calls:      {_api_call_count}")
         print(f"  Input tokens:   {_total_input_tokens:,}")
+        print(f"  Cache writes:   {_total_cache_write_tokens:,}")
+        print(f"  Cache reads:    {_total_cache_read_tokens:,}")
         print(f"  Output tokens:  {_total_output_tokens:,}")
         print(f"  Total cost:     ${_total_cost:.4f}")
         print(f"  Cost/minute:    ${_total_cost/max(elapsed_min,0.1):.4f}")
@@ -6,13 +6,14 @@ Uses a persistent browser profile so SSO/corporate logins are fully captured.
 
 import asyncio
 import os
-from playwright.async_api import async_playwright
 
 TRAINING_URL   = os.getenv("TRAINING_URL", "https://your-training-platform.com")
 PROFILE_DIR    = "./browser-profile"   # Persistent profile folder
 
 
 async def save_session():
+    from playwright.async_api import async_playwright  # Heavy import, only needed here
+
     async with async_playwright() as pw:
         # Persistent context writes cookies/storage to disk continuously
         context = await pw.chromium.launch_persistent_context(